@@ -4,17 +4,25 @@ TENEVERSIYA Sound Design Bot
 Telegram Mini App Backend for Render.com
 """
 import asyncio
-import json
+import atexit
+import html
 import logging
-import hashlib
+import logging.handlers
 import hmac
 import os
+import queue
+import secrets
 import signal
 import sys
-from datetime import datetime
-from urllib.parse import parse_qsl
+from datetime import datetime, timezone
+from typing import Any, Final, Union
+from urllib.parse import unquote_plus
+import msgspec
+import orjson
 from aiohttp import web
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from aiogram.types import (
     Message,
     ReplyKeyboardMarkup,
@@ -22,6 +30,8 @@ from aiogram.types import (
     WebAppInfo
 )
 from aiogram.enums import ParseMode
+from aiogram.filters import Command, CommandStart
+from aiogram.exceptions import TelegramRetryAfter
 
 # ============================================
 # CONFIGURATION
@@ -35,14 +45,33 @@ WEB_APP_URL = os.environ.get('WEB_APP_URL', 'https://molodoylord.github.io/tenev
 # Порт для health-check (Render требует открытый порт)
 PORT = int(os.environ.get('PORT', 10000))
 
+# Публичный адрес сервиса для webhook (Render сам выставляет RENDER_EXTERNAL_URL)
+PUBLIC_URL = os.environ.get('PUBLIC_URL') or os.environ.get('RENDER_EXTERNAL_URL', '')
+WEBHOOK_PATH = '/webhook'
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token — если не задан, генерируем при старте
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
 # ============================================
 # LOGGING SETUP
 # ============================================
+# Хендлеры только кладут запись в очередь; форматирование и запись в stdout
+# делает QueueListener в отдельном потоке — event loop не блокируется
+_log_queue = queue.Queue(-1)
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+)
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# QueueHandler.prepare() форматирует запись сам — оставляем только текст,
+# полный формат применяет _log_stream в листенере
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(message)s',
     handlers=[
-        logging.StreamHandler(sys.stdout)
+        logging.handlers.QueueHandler(_log_queue)
     ]
 )
 logger = logging.getLogger(__name__)
@@ -50,66 +79,134 @@ logger = logging.getLogger(__name__)
 # ============================================
 # BOT INITIALIZATION (БЕЗ прокси — на Render не нужен)
 # ============================================
-bot = Bot(token=TOKEN)
+class KeepAliveSession(AiohttpSession):
+    """AiohttpSession that keeps idle TLS connections to api.telegram.org longer"""
+
+    # Дополняем параметры TCPConnector, которые собирает aiogram
+    # (его ssl-контекст и ttl_dns_cache остаются как есть)
+    CONNECTOR_EXTRA = {'keepalive_timeout': 75}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init.update(self.CONNECTOR_EXTRA)
+
+    def _setup_proxy_connector(self, proxy):
+        # Прокси-коннектор пересобирает параметры с нуля — дополняем заново
+        super()._setup_proxy_connector(proxy)
+        self._connector_init.update(self.CONNECTOR_EXTRA)
+
+
+# orjson вместо stdlib json — быстрее парсит апдейты от Telegram
+session = KeepAliveSession(
+    json_loads=orjson.loads,
+    json_dumps=lambda obj: orjson.dumps(obj).decode()
+)
+bot = Bot(token=TOKEN, session=session)
 dp = Dispatcher()
 
+# Ограничиваем число одновременных исходящих запросов к Telegram API
+# (глобальный лимит ~30 msg/s — при всплеске заказов иначе ловим 429)
+_SEND_SEM = asyncio.Semaphore(20)
+
+
+async def send_limited(method, *args, **kwargs):
+    """Call bot API method under _SEND_SEM, retrying once on flood control"""
+    try:
+        async with _SEND_SEM:
+            return await method(*args, **kwargs)
+    except TelegramRetryAfter as e:
+        retry_after = e.retry_after
+        logger.warning(f"Flood control, retry in {retry_after}s")
+
+    # Ждём вне семафора — иначе один 429 держит слот всё окно ожидания
+    await asyncio.sleep(retry_after)
+    async with _SEND_SEM:
+        return await method(*args, **kwargs)
+
+
 # ============================================
-# HEALTH-CHECK HTTP SERVER
+# HTTP SERVER: HEALTH-CHECK + WEBHOOK
 # Render.com пингует сервис — если нет ответа, убивает процесс.
-# Это простой HTTP сервер, который отвечает "OK" на любой запрос.
+# На этом же сервере Telegram присылает апдейты в WEBHOOK_PATH.
 # ============================================
 
+# Тело ответа готовим заранее — без кодирования строки на каждый пинг
+_OK_BODY = b"OK"
+
+
 async def health_check(request):
     """Health check endpoint for Render"""
-    return web.Response(text="OK", status=200)
+    return web.Response(body=_OK_BODY, status=200, content_type='text/plain')
 
 
 async def start_health_server():
-    """Start minimal HTTP server for Render health checks"""
+    """Start HTTP server for Render health checks and Telegram webhook"""
     app = web.Application()
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
 
-    runner = web.AppRunner(app)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+
+    # access_log=None — Render пингует часто, строка лога на каждый пинг не нужна
+    runner = web.AppRunner(app, access_log=None, handle_signals=False)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', PORT)
+    site = web.TCPSite(runner, '0.0.0.0', PORT, backlog=128)
     await site.start()
-    logger.info(f"Health-check server started on port {PORT}")
+    logger.info(f"HTTP server started on port {PORT} (health + {WEBHOOK_PATH})")
     return runner
 
 
 # ============================================
 # SECURITY: Validate Telegram WebApp Data
 # ============================================
-def validate_init_data(init_data: str, bot_token: str) -> bool:
+# Токен не меняется за время жизни процесса — secret key считаем один раз
+_SECRET_KEY = hmac.digest(b"WebAppData", TOKEN.encode(), 'sha256') if TOKEN else None
+
+
+def _split_init(init_data: str):
+    """Single-pass initData parser: returns (hash, other fields)"""
+    fields = {}
+    received_hash = None
+    for pair in init_data.split('&'):
+        if not pair:
+            continue
+        key, _, value = pair.partition('=')
+        value = unquote_plus(value)
+        if key == 'hash':
+            received_hash = value
+        else:
+            fields[unquote_plus(key)] = value
+    return received_hash, fields
+
+
+def validate_init_data(init_data: str) -> bool:
     """
     Validate Telegram WebApp init data to prevent spoofing.
     """
     try:
-        parsed_data = dict(parse_qsl(init_data))
+        received_hash, parsed_data = _split_init(init_data)
 
-        if 'hash' not in parsed_data:
+        if received_hash is None or _SECRET_KEY is None:
             return False
 
-        received_hash = parsed_data.pop('hash')
+        # '='.join по кортежам (k, v) — без f-строк, одно .encode() в конце
+        data_check_bytes = '\n'.join(
+            map('='.join, sorted(parsed_data.items()))
+        ).encode()
 
-        data_check_string = '\n'.join(
-            f"{k}={v}" for k, v in sorted(parsed_data.items())
-        )
-
-        secret_key = hmac.new(
-            b"WebAppData",
-            bot_token.encode(),
-            hashlib.sha256
-        ).digest()
-
-        calculated_hash = hmac.new(
-            secret_key,
-            data_check_string.encode(),
-            hashlib.sha256
-        ).hexdigest()
+        # hmac.digest — one-shot C fast path, без объекта hmac.HMAC
+        calculated_hash = hmac.digest(
+            _SECRET_KEY,
+            data_check_bytes,
+            'sha256'
+        ).hex()
 
-        return hmac.compare_digest(received_hash, calculated_hash)
+        # hash присылает клиент — сравниваем байты, иначе не-ASCII даёт TypeError
+        return hmac.compare_digest(received_hash.encode(), calculated_hash.encode())
 
     except Exception as e:
         logger.error(f"Validation error: {e}")
@@ -143,31 +240,63 @@ QUALITY_NAMES = {
 
 
 # ============================================
-# HANDLERS
+# ORDER PAYLOAD (JSON от WebApp, camelCase-поля)
 # ============================================
+# Поля только для отображения: клиент может прислать что угодно (строку, число,
+# null, список...) — как и раньше с dict.get, выводим через str()
+_Text = Any
 
-@dp.message(F.text == "/start")
-async def cmd_start(message: Message):
-    """Handle /start command"""
 
-    logger.info(f"User {message.from_user.id} started the bot")
+class Order(msgspec.Struct, rename="camel"):
+    """Order submitted from the WebApp (decoded with strict=False)"""
+    init_data: _Text = None
+    name: _Text = None
+    phone: _Text = None
+    username: _Text = None
+    user_id: _Text = None
+    service: _Text = None
+    service_name: _Text = None
+    need_lyrics: _Text = None
+    genre: _Text = None
+    genre_name: _Text = None
+    quality: _Text = None
+    quality_name: _Text = None
+    price: Union[int, float, None] = None
+    comment: _Text = None
+    timestamp: _Text = None
+
+
+def _text(value: _Text, default) -> str:
+    """Escape display-only order field for HTML (null/absent → default)"""
+    return html.escape(str(default if value is None else value))
+
+
+def _lookup(names: dict, key: _Text) -> _Text:
+    """Human-readable name for a service/genre/quality code (unknown → the code)"""
+    return names.get(key, key) if isinstance(key, (str, int, float)) else key
 
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(
-                text="🕯 Сделать заказ",
-                web_app=WebAppInfo(url=WEB_APP_URL)
-            )]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=False
-    )
 
-    welcome_text = """
+# ============================================
+# STATIC TEXTS & KEYBOARD (создаются один раз при загрузке)
+# ============================================
+_SEP: Final = "━━━━━━━━━━━━━━━━━━━━"
+
+START_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(
+            text="🕯 Сделать заказ",
+            web_app=WebAppInfo(url=WEB_APP_URL)
+        )]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False
+)
+
+WELCOME_TEXT = f"""
 <b>🌑 TENEVERSIYA</b>
 <i>Sound Design Studio</i>
 
-━━━━━━━━━━━━━━━━━━━━
+{_SEP}
 
 Добро пожаловать в мир тёмного звука.
 
@@ -177,23 +306,12 @@ async def cmd_start(message: Message):
 • Аранжировки любой сложности
 • Треки под ключ
 
-━━━━━━━━━━━━━━━━━━━━
+{_SEP}
 
 <b>Нажми кнопку ниже, чтобы оформить заказ</b>
 """
 
-    await message.answer(
-        welcome_text,
-        reply_markup=keyboard,
-        parse_mode=ParseMode.HTML
-    )
-
-
-@dp.message(F.text == "/help")
-async def cmd_help(message: Message):
-    """Handle /help command"""
-
-    help_text = """
+HELP_TEXT = """
 <b>📖 Помощь</b>
 
 <b>Как сделать заказ:</b>
@@ -206,72 +324,35 @@ async def cmd_help(message: Message):
 /help - Эта справка
 """
 
-    await message.answer(help_text, parse_mode=ParseMode.HTML)
-
-
-@dp.message(F.web_app_data)
-async def handle_webapp_data(message: Message):
-    """Handle data received from WebApp"""
-
-    try:
-        data = json.loads(message.web_app_data.data)
-
-        logger.info(f"Received order from user {message.from_user.id}: {data}")
-
-        name = data.get('name', 'Не указано')
-        phone = data.get('phone', 'Не указан')
-        username = data.get('username', 'Скрыт')
-        user_id = data.get('userId', message.from_user.id)
-
-        service = data.get('service', 'N/A')
-        service_name = data.get('serviceName', SERVICE_NAMES.get(service, service))
-        need_lyrics = data.get('needLyrics', False)
-
-        genre = data.get('genre', 'N/A')
-        genre_name = data.get('genreName', GENRE_NAMES.get(genre, genre))
-
-        quality = data.get('quality', 'N/A')
-        quality_name = data.get('qualityName', QUALITY_NAMES.get(quality, quality))
-
-        price = data.get('price', 0)
-        comment = data.get('comment', '')
-        timestamp = data.get('timestamp', datetime.now().isoformat())
-
-        lyrics_info = "✅ Да" if need_lyrics else "❌ Нет"
-
-        admin_report = f"""
+# Шаблоны сообщений о заказе — заполняются через str.format_map
+# (разделитель подставлен сразу, поэтому плейсхолдеры в двойных скобках)
+_ADMIN_TPL = f"""
 <b>🌑 НОВЫЙ ЗАКАЗ</b>
-━━━━━━━━━━━━━━━━━━━━
+{_SEP}
 
 <b>👤 Клиент:</b>
-├ Имя: <code>{name}</code>
-├ Телефон: <code>{phone}</code>
-├ Username: @{username}
-└ ID: <code>{user_id}</code>
+├ Имя: <code>{{name}}</code>
+├ Телефон: <code>{{phone}}</code>
+├ Username: @{{username}}
+└ ID: <code>{{user_id}}</code>
 
 <b>📋 Заказ:</b>
-├ Услуга: {service_name}
-├ Нужен текст: {lyrics_info}
-├ Жанр: {genre_name}
-└ Качество: {quality_name}
+├ Услуга: {{service_name}}
+├ Нужен текст: {{lyrics_info}}
+├ Жанр: {{genre_name}}
+└ Качество: {{quality_name}}
 
 <b>💰 Итоговая цена:</b>
-<code>{price:,} ₽</code>
+<code>{{price:,}} ₽</code>
 
 <b>💬 Комментарий:</b>
-<i>{comment if comment else 'Не указан'}</i>
+<i>{{comment}}</i>
 
-━━━━━━━━━━━━━━━━━━━━
-<i>🕐 {timestamp}</i>
+{_SEP}
+<i>🕐 {{timestamp}}</i>
 """
 
-        await bot.send_message(
-            ADMIN_ID,
-            admin_report,
-            parse_mode=ParseMode.HTML
-        )
-
-        user_confirmation = f"""
+_USER_TPL = """
 <b>✅ Заказ принят!</b>
 
 Спасибо, <b>{name}</b>!
@@ -285,23 +366,147 @@ async def handle_webapp_data(message: Message):
 <i>🌑 TENEVERSIYA</i>
 """
 
-        await message.answer(
-            user_confirmation,
-            parse_mode=ParseMode.HTML
+
+# ============================================
+# HANDLERS
+# ============================================
+
+@dp.message(CommandStart())
+async def cmd_start(message: Message):
+    """Handle /start command"""
+
+    logger.info(f"User {message.from_user.id} started the bot")
+
+    await send_limited(
+        message.answer,
+        WELCOME_TEXT,
+        reply_markup=START_KEYBOARD,
+        parse_mode=ParseMode.HTML
+    )
+
+
+@dp.message(Command("help"))
+async def cmd_help(message: Message):
+    """Handle /help command"""
+
+    await send_limited(message.answer, HELP_TEXT, parse_mode=ParseMode.HTML)
+
+
+@dp.message(F.web_app_data)
+async def handle_webapp_data(message: Message):
+    """Handle data received from WebApp"""
+
+    sender_id = message.from_user.id
+
+    try:
+        # strict=False: "1500" → 1500 — тип одного поля не должен ронять заказ
+        order = msgspec.json.decode(message.web_app_data.data, type=Order, strict=False)
+
+        # Проверяем подпись Telegram до любой обработки полей
+        if not isinstance(order.init_data, str) or not validate_init_data(order.init_data):
+            logger.warning(f"Invalid initData from user {sender_id}")
+            return await send_limited(
+                message.answer,
+                "❌ Ошибка авторизации",
+                parse_mode=ParseMode.HTML
+            )
+        order.init_data = None
+
+        logger.info(f"Received order from user {sender_id}: {order}")
+
+        # Всё, что пришло от клиента, экранируем перед вставкой в HTML
+        name = _text(order.name, 'Не указано')
+        phone = _text(order.phone, 'Не указан')
+        username = _text(order.username, 'Скрыт')
+        user_id = _text(order.user_id, sender_id)
+
+        service = 'N/A' if order.service is None else order.service
+        service_name = _text(order.service_name, _lookup(SERVICE_NAMES, service))
+
+        genre = 'N/A' if order.genre is None else order.genre
+        genre_name = _text(order.genre_name, _lookup(GENRE_NAMES, genre))
+
+        quality = 'N/A' if order.quality is None else order.quality
+        quality_name = _text(order.quality_name, _lookup(QUALITY_NAMES, quality))
+
+        price = order.price or 0
+        comment = _text(order.comment, '')
+        # Время подставляем только если клиент его не прислал
+        timestamp = (
+            html.escape(str(order.timestamp)) if order.timestamp
+            else datetime.now(timezone.utc).isoformat(timespec='seconds')
         )
 
-        logger.info(f"Order processed successfully for user {message.from_user.id}")
+        lyrics_info = "✅ Да" if order.need_lyrics else "❌ Нет"
+
+        admin_report = _ADMIN_TPL.format_map({
+            'name': name,
+            'phone': phone,
+            'username': username,
+            'user_id': user_id,
+            'service_name': service_name,
+            'lyrics_info': lyrics_info,
+            'genre_name': genre_name,
+            'quality_name': quality_name,
+            'price': price,
+            'comment': comment or 'Не указан',
+            'timestamp': timestamp
+        })
+
+        user_confirmation = _USER_TPL.format_map({
+            'name': name,
+            'service_name': service_name,
+            'price': price
+        })
+
+        # Админу и клиенту отправляем параллельно — один round-trip вместо двух
+        admin_result, user_result = await asyncio.gather(
+            send_limited(
+                bot.send_message,
+                ADMIN_ID,
+                admin_report,
+                parse_mode=ParseMode.HTML
+            ),
+            send_limited(
+                message.answer,
+                user_confirmation,
+                parse_mode=ParseMode.HTML
+            ),
+            return_exceptions=True
+        )
 
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e}")
-        await message.answer(
+        if isinstance(user_result, Exception):
+            logger.error(f"Failed to confirm order to user {sender_id}: {user_result}")
+
+        if isinstance(admin_result, Exception):
+            # Заказ до админа не дошёл — полный отчёт в лог. Клиент мог уже получить
+            # «Заказ принят», поэтому шлём уточнение, а не просьбу отправить заново
+            logger.error(f"Failed to notify admin: {admin_result}\n{admin_report}")
+            await send_limited(
+                message.answer,
+                "⚠️ Заказ получен, но из-за технической ошибки не передан менеджеру.\n\n"
+                "<b>Не отправляй его повторно</b> — напиши нам напрямую, и мы всё уточним.",
+                parse_mode=ParseMode.HTML
+            )
+            return
+
+        if isinstance(user_result, Exception):
+            return
+
+        logger.info(f"Order processed successfully for user {sender_id}")
+
+    except msgspec.DecodeError as e:
+        logger.error(f"Order decode error: {e}")
+        await send_limited(
+            message.answer,
             "❌ Ошибка при обработке заказа. Попробуй ещё раз.",
             parse_mode=ParseMode.HTML
         )
 
     except Exception as e:
         logger.error(f"Error processing order: {e}")
-        await message.answer(
+        await send_limited(
+            message.answer,
             "❌ Произошла ошибка. Пожалуйста, попробуй позже или напиши нам напрямую.",
             parse_mode=ParseMode.HTML
         )
@@ -311,7 +516,8 @@ async def handle_webapp_data(message: Message):
 async def handle_unknown(message: Message):
     """Handle unknown messages"""
 
-    await message.answer(
+    await send_limited(
+        message.answer,
         "🌑 Используй кнопку <b>«🕯 Сделать заказ»</b> для оформления заказа.\n\n"
         "Или напиши /help для справки.",
         parse_mode=ParseMode.HTML
@@ -328,6 +534,7 @@ async def main():
     logger.info("Starting TENEVERSIYA Bot on Render.com...")
     logger.info(f"PORT: {PORT}")
     logger.info(f"WEB_APP_URL: {WEB_APP_URL}")
+    logger.info(f"PUBLIC_URL: {PUBLIC_URL or 'NOT SET!'}")
     logger.info(f"ADMIN_ID: {ADMIN_ID}")
     logger.info(f"BOT_TOKEN: {'SET' if TOKEN else 'NOT SET!'}")
     logger.info("=" * 50)
@@ -340,16 +547,35 @@ async def main():
         logger.error("ADMIN_ID is not set! Add it to Render environment variables.")
         sys.exit(1)
 
-    # Start health-check HTTP server (Render needs this!)
+    if not PUBLIC_URL:
+        logger.error("PUBLIC_URL is not set! Add it to Render environment variables.")
+        sys.exit(1)
+
+    # Render останавливает сервис через SIGTERM — без обработчика процесс
+    # умирает сразу и finally ниже не выполняется
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows: add_signal_handler не поддерживается, Ctrl+C и так даёт KeyboardInterrupt
+            pass
+
+    # Start HTTP server: health-check (Render needs this!) + webhook
     health_runner = await start_health_server()
 
-    # Delete webhook and start polling
-    await bot.delete_webhook(drop_pending_updates=True)
+    try:
+        # Telegram сам присылает апдейты — никакого long polling
+        await bot.set_webhook(
+            f"{PUBLIC_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=True
+        )
 
-    logger.info("Bot is running! Polling started.")
+        logger.info("Bot is running! Webhook set.")
 
-    try:
-        await dp.start_polling(bot)
+        await stop_event.wait()
     finally:
         logger.info("Shutting down...")
         await health_runner.cleanup()
@@ -360,4 +586,11 @@ async def main():
 # ENTRY POINT
 # ============================================
 if __name__ == "__main__":
+    # uvloop — более быстрый event loop (если установлен)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     asyncio.run(main())